@@ -1,6 +1,7 @@
 # ./modules/<module_name>/module.py
 import os
 import json
+import re
 import logging
 import asyncio
 from aiogram import Router, types
@@ -14,9 +15,33 @@ logger = logging.getLogger(__name__)
 # Инициализация роутера
 router = Router()
 
+# Имя модуля и таблицы настроек (вычисляются один раз при импорте)
+# В ядре модуль импортируется как modules.<name>.module; при импорте вне пакета берём само имя файла
+_name_parts = __name__.split(".")
+_MODULE_NAME = _name_parts[-2] if len(_name_parts) > 1 else _name_parts[0]  # Автоматическое определение имени модуля
+_TABLE_NAME = f"{_MODULE_NAME}_config"
+
+# Имя таблицы подставляется в SQL напрямую, поэтому допускаем только идентификатор
+if not re.fullmatch(r"[A-Za-z_]\w*", _MODULE_NAME):
+    raise ValueError(f"Недопустимое имя модуля для имени таблицы: {_MODULE_NAME!r}")
+
+# SQL-запросы модуля
+_SQL_CREATE_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {_TABLE_NAME} (
+        user_id INTEGER PRIMARY KEY,
+        example_user_param TEXT
+    )
+"""
+_SQL_GET_USER = f"SELECT example_user_param FROM {_TABLE_NAME} WHERE user_id = ?"
+_SQL_SET_USER = f"INSERT OR REPLACE INTO {_TABLE_NAME} (user_id, example_user_param) VALUES (?, ?)"
+_SQL_DELETE_USER = f"DELETE FROM {_TABLE_NAME} WHERE user_id = ?"
+
 # Глобальная переменная для хранения данных ядра
 _kernel_data = None
 
+# Кэш config.json: файл перечитывается только при изменении mtime
+_config_cache = {"mtime": 0, "data": None}
+
 # Определение состояний FSM (если нужны)
 class ModuleStates(StatesGroup):
     waiting_for_input = State()
@@ -39,6 +64,10 @@ USER_PARAMETERS = {  # Пользовательские настройки
     }
 }
 
+# Значения по умолчанию (вычисляются один раз при импорте; изменяемую копию брать через .copy())
+_GLOBAL_DEFAULTS = {key: info["default"] for key, info in GLOBAL_PARAMETERS.items()}
+_USER_DEFAULTS = {key: info["default"] for key, info in USER_PARAMETERS.items()}
+
 def setup(kernel_data):
     """Инициализация модуля при загрузке."""
     global _kernel_data
@@ -51,6 +80,8 @@ def setup(kernel_data):
     if db is None:
         logger.error("База данных не инициализирована в kernel_data['db']!")
         raise ValueError("База данных не инициализирована!")
+    # Соединение kernel_data["db"] общее для всех модулей: записи (execute...commit) идут под общим локом
+    kernel_data.setdefault("db_write_lock", asyncio.Lock())
     
     asyncio.create_task(init_db(db))
     init_config(base_dir)
@@ -59,33 +90,28 @@ def setup(kernel_data):
 
 async def init_db(db):
     """Инициализация таблицы для хранения пользовательских настроек."""
-    module_name = __name__.split(".")[-2]  # Автоматическое определение имени модуля
-    table_name = f"{module_name}_config"
     try:
-        async with db.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'") as cursor:
-            if not await cursor.fetchone():
-                await db.execute(f"""
-                    CREATE TABLE {table_name} (
-                        user_id INTEGER PRIMARY KEY,
-                        example_user_param TEXT
-                    )
-                """)
+        async with _kernel_data["db_write_lock"]:
+            try:
+                await db.execute(_SQL_CREATE_TABLE)
                 await db.commit()
-                logger.info(f"Таблица {table_name} создана")
+            except Exception:
+                await db.rollback()
+                raise
+        logger.info(f"Таблица {_TABLE_NAME} инициализирована")
     except Exception as e:
         logger.error(f"Ошибка при инициализации базы данных: {e}")
         raise
 
 def init_config(base_dir):
     """Инициализация конфигурационного файла модуля."""
-    module_name = __name__.split(".")[-2]
-    config_path = os.path.join(base_dir, "modules", module_name, "config.json")
+    config_path = os.path.join(base_dir, "modules", _MODULE_NAME, "config.json")
     try:
         if not os.path.exists(config_path):
             os.makedirs(os.path.dirname(config_path), exist_ok=True)
-            default_config = {key: info["default"] for key, info in GLOBAL_PARAMETERS.items()}
             with open(config_path, "w", encoding="utf-8") as f:
-                json.dump(default_config, f, indent=4)
+                json.dump(_GLOBAL_DEFAULTS, f, indent=4)
+            invalidate_config_cache()
             logger.info(f"Создан новый config.json: {config_path}")
     except Exception as e:
         logger.error(f"Ошибка при инициализации конфигурации: {e}")
@@ -93,26 +119,40 @@ def init_config(base_dir):
 
 def load_config(base_dir):
     """Загрузка конфигурации модуля."""
-    module_name = __name__.split(".")[-2]
-    config_path = os.path.join(base_dir, "modules", module_name, "config.json")
+    config_path = os.path.join(base_dir, "modules", _MODULE_NAME, "config.json")
     try:
         if os.path.exists(config_path):
             with open(config_path, "r", encoding="utf-8") as f:
                 return json.load(f)
-        return {key: info["default"] for key, info in GLOBAL_PARAMETERS.items()}
+        return _GLOBAL_DEFAULTS.copy()
     except Exception as e:
         logger.error(f"Ошибка при загрузке конфигурации: {e}")
-        return {key: info["default"] for key, info in GLOBAL_PARAMETERS.items()}
+        return _GLOBAL_DEFAULTS.copy()
+
+def load_config_cached(base_dir):
+    """Загрузка конфигурации модуля из кэша (перечитывается при изменении файла)."""
+    config_path = os.path.join(base_dir, "modules", _MODULE_NAME, "config.json")
+    try:
+        mtime = os.stat(config_path).st_mtime_ns
+    except OSError:
+        return load_config(base_dir)
+    if _config_cache["data"] is None or _config_cache["mtime"] != mtime:
+        _config_cache["data"] = load_config(base_dir)
+        _config_cache["mtime"] = mtime
+    return _config_cache["data"]
+
+def invalidate_config_cache():
+    """Сброс кэша конфигурации. Вызывать после каждой записи config.json."""
+    _config_cache["mtime"] = 0
+    _config_cache["data"] = None
 
 async def get_user_config(db, user_id):
     """Получение пользовательских настроек из базы данных."""
     if db is None:
         logger.error("База данных не инициализирована!")
         return {}
-    module_name = __name__.split(".")[-2]
-    table_name = f"{module_name}_config"
     try:
-        async with db.execute(f"SELECT example_user_param FROM {table_name} WHERE user_id = ?", (user_id,)) as cursor:
+        async with db.execute(_SQL_GET_USER, (user_id,)) as cursor:
             row = await cursor.fetchone()
             if row:
                 return {"example_user_param": row[0]}
@@ -126,18 +166,18 @@ async def set_user_config(db, user_id, config):
     if db is None:
         logger.error("База данных не инициализирована!")
         return
-    module_name = __name__.split(".")[-2]
-    table_name = f"{module_name}_config"
     try:
-        if config is None:
-            await db.execute(f"DELETE FROM {table_name} WHERE user_id = ?", (user_id,))
-        else:
-            param = config.get("example_user_param", USER_PARAMETERS["example_user_param"]["default"])
-            await db.execute(
-                f"INSERT OR REPLACE INTO {table_name} (user_id, example_user_param) VALUES (?, ?)",
-                (user_id, param)
-            )
-        await db.commit()
+        async with _kernel_data["db_write_lock"]:
+            try:
+                if config is None:
+                    await db.execute(_SQL_DELETE_USER, (user_id,))
+                else:
+                    param = config.get("example_user_param", _USER_DEFAULTS["example_user_param"])
+                    await db.execute(_SQL_SET_USER, (user_id, param))
+                await db.commit()
+            except Exception:
+                await db.rollback() # Откат под тем же локом, чтобы полутранзакцию не зафиксировал чужой commit
+                raise
         logger.info(f"Настройки пользователя {user_id} обновлены: {config}")
     except Exception as e:
         logger.error(f"Ошибка при сохранении настроек пользователя {user_id}: {e}")
@@ -145,49 +185,46 @@ async def set_user_config(db, user_id, config):
 
 async def get_settings_menu(user_id, is_enabled, admin_ids, kernel_data):
     """Формирование меню настроек модуля."""
-    module_name = __name__.split(".")[-2]
-    text = (f"📋 **{DISPLAY_NAME}** ({'🟢 Вкл' if is_enabled else '🔴 Выкл'})\n"
-            f"📝 **Описание:** {DESCRIPTION}\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"⚙️ **Текущие настройки:**\n")
+    text_parts = [f"📋 **{DISPLAY_NAME}** ({'🟢 Вкл' if is_enabled else '🔴 Выкл'})\n"
+                  f"📝 **Описание:** {DESCRIPTION}\n"
+                  f"━━━━━━━━━━━━━━━━━━━━━━━\n"
+                  f"⚙️ **Текущие настройки:**\n"]
     
     keyboard = []
     
     # Глобальные параметры (для админов)
     if user_id in admin_ids:
-        global_config = load_config(kernel_data["base_dir"])
+        global_config = load_config_cached(kernel_data["base_dir"])
         for param, info in GLOBAL_PARAMETERS.items():
             value = global_config.get(param, info["default"])
-            text += f"🔧 {info['description']}: **{value}**\n"
-        text += "\n"
-        for param in GLOBAL_PARAMETERS:
+            text_parts.append(f"🔧 {info['description']}: **{value}**\n")
             keyboard.append([types.InlineKeyboardButton(
                 text=f"🔧 Изменить {param}",
-                callback_data=f"set_global_{module_name}_{param}"
+                callback_data=f"set_global_{_MODULE_NAME}_{param}"
             )])
+        text_parts.append("\n")
         keyboard.append([types.InlineKeyboardButton(
             text=f"{'🔴 Выключить' if is_enabled else '🟢 Включить'}",
-            callback_data=f"toggle_{module_name}"
+            callback_data=f"toggle_{_MODULE_NAME}"
         )])
         keyboard.append([types.InlineKeyboardButton(
             text="🗑️ Удалить модуль",
-            callback_data=f"delete_module_{module_name}"
+            callback_data=f"delete_module_{_MODULE_NAME}"
         )])
 
     # Пользовательские параметры
     user_config = await get_user_config(kernel_data["db"], user_id)
     for param, info in USER_PARAMETERS.items():
         value = user_config.get(param, info["default"])
-        text += f"👤 {info['description']}: **{value}**\n"
-    for param in USER_PARAMETERS:
+        text_parts.append(f"👤 {info['description']}: **{value}**\n")
         keyboard.append([types.InlineKeyboardButton(
             text=f"👤 Изменить {param}",
-            callback_data=f"set_user_{module_name}_{param}"
+            callback_data=f"set_user_{_MODULE_NAME}_{param}"
         )])
     if user_config:
         keyboard.append([types.InlineKeyboardButton(
             text="🗑️ Удалить мои настройки",
-            callback_data=f"delete_config_{module_name}"
+            callback_data=f"delete_config_{_MODULE_NAME}"
         )])
     
     keyboard.append([types.InlineKeyboardButton(
@@ -195,7 +232,7 @@ async def get_settings_menu(user_id, is_enabled, admin_ids, kernel_data):
         callback_data="list_modules"
     )])
     
-    return text, keyboard
+    return "".join(text_parts), keyboard
 
 @router.message(Command("command_name"))
 async def command_handler(message: types.Message, state: FSMContext):
@@ -209,7 +246,9 @@ async def command_handler(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка: база данных не инициализирована!")
         return
     
-    args = message.text.replace("/command_name", "").strip()
+    # Команда всегда стоит в начале (возможно, с @botname) — отделяем её одним split
+    parts = message.text.split(maxsplit=1)
+    args = parts[1].strip() if len(parts) > 1 else ""
     if args:
         await message.answer(f"Вы ввели: {args}")
     else:
@@ -1,13 +1,21 @@
 # /modules/gemini_ai/module.py
 
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import os
+import queue
+import importlib.util
 import asyncio
+import hashlib
+import time
 import aiosqlite
 import re
+import zlib
+import shutil
+import tempfile
 import json # Добавили для работы с config.json
-from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from typing import Dict, Any, List, Tuple, Optional
 
 import aiohttp
@@ -34,18 +42,46 @@ except ImportError:
     logging.getLogger(__name__).error("Библиотека 'cryptography' не найдена! Шифрование ключей API невозможно. Установите: pip install cryptography")
 
 
-# Попробуем импортировать black
+# orjson (если установлен) сериализует большие промпты в разы быстрее stdlib json
 try:
-    import black
-    BLACK_AVAILABLE = True
+    import orjson
 except ImportError:
-    BLACK_AVAILABLE = False
-    black = None
+    orjson = None
+
+def _json_dumps(obj: Any) -> bytes:
+    """Сериализует объект в JSON (bytes), используя orjson при наличии."""
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def _json_loads(data: bytes | str) -> Any:
+    """Разбирает JSON, используя orjson при наличии."""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+# black нужен только для проверки доступности /format: сам пакет не импортируем,
+# чтобы не тянуть его зависимости (blib2to3, click, pathspec) при старте бота
+BLACK_AVAILABLE = importlib.util.find_spec("black") is not None
 
 # --- Логгер модуля ---
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Запись лог-файла идёт в фоновом потоке QueueListener: logger.info из обработчиков
+# только кладёт запись в очередь и не блокирует event loop на файловом I/O и ротации
+_log_listener: QueueListener | None = None
+
+def _remove_queue_handlers(log_path: str | None = None):
+    """Снимает с логгера модуля QueueHandler'ы (все или только для log_path) и останавливает их слушателей.
+
+    Слушатель хранится на самом хендлере (атрибут log_listener): логгер и хендлер переживают /reload модуля,
+    поэтому слушатель прошлого экземпляра модуля можно найти и остановить, даже если on_shutdown не вызывался.
+    """
+    for h in [h for h in logger.handlers if isinstance(h, QueueHandler) and (log_path is None or getattr(h, "log_path", None) == log_path)]:
+        logger.removeHandler(h) # Дальше записи в очередь не попадают
+        listener = getattr(h, "log_listener", None)
+        if listener is not None:
+            h.log_listener = None # stop() не идемпотентен до Python 3.12.3
+            listener.stop() # Дописывает оставшиеся в очереди записи
+            for lh in listener.handlers: lh.close()
+
 # --- Роутер модуля ---
 router = Router()
 
@@ -61,45 +97,157 @@ cancel_kb = ReplyKeyboardMarkup(keyboard=[[cancel_button]], resize_keyboard=True
 # --- Переменные уровня модуля ---
 CONTEXT_PATH: str | None = None
 DEFAULT_CONTEXT: str = "Я — SwiftDevBot, Telegram-бот, созданный для помощи в разработке и ответов на вопросы."
+_project_context: str = DEFAULT_CONTEXT # Содержимое CONTEXT_PATH, читается в setup
+_ctx_mtime: int | None = None # st_mtime_ns прочитанного файла (None — файла нет)
+
+# Общая HTTP-сессия для запросов к Gemini: пул соединений с keep-alive, чтобы не платить
+# за DNS + TCP + TLS на каждый вопрос. Создаётся в on_startup, закрывается в on_shutdown.
+_session: aiohttp.ClientSession | None = None
+
+# Дешифрованный ключ API: (зашифрованная строка из конфига, ключ). Fernet (AES + HMAC)
+# выполняется только при смене ключа в конфиге, а не на каждый вопрос
+_key_cache: tuple[str, str] | None = None
+
+# LRU-кэш ответов в памяти перед таблицей gemini_cache (вопрос -> (unix-время записи ответа, ответ)).
+# Время записи нужно, чтобы срок жизни CACHE_TTL_DAYS соблюдался и для ответов из памяти
+_ANSWER_CACHE_MAX = 1024
+_answer_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+# Негативный кэш: вопросы, на которые Gemini не выдал кандидата (фильтр), не отправляются
+# повторно в течение _NEGATIVE_CACHE_TTL секунд ((chat_id, вопрос) -> (monotonic истечения, ответ)).
+# Ключ включает chat_id: блокировка зависит от всего промпта — истории и режима этого чата
+_NEGATIVE_CACHE_TTL = 300
+_NEGATIVE_CACHE_MAX = 256
+_negative_cache: "OrderedDict[Tuple[int, str], Tuple[float, str]]" = OrderedDict()
+
+# Срок жизни и размер gemini_cache: фоновая задача раз в CACHE_GC_INTERVAL секунд удаляет
+# записи старше CACHE_TTL_DAYS и самые старые сверх CACHE_MAX_ROWS
+CACHE_TTL_DAYS = 7
+CACHE_MAX_ROWS = 10000
+CACHE_GC_INTERVAL = 3600
+_cache_gc_task: asyncio.Task | None = None
+
+# Границы длины вопроса: длиннее MAX_QUESTION_LENGTH не принимаются вовсе, длиннее
+# CACHE_QUESTION_MAX_LENGTH не кэшируются (длинные вставки почти не повторяются)
+MAX_QUESTION_LENGTH = 4000
+CACHE_QUESTION_MAX_LENGTH = 1024
+
+# Режимы общения по chat_id: таблица gemini_settings целиком, загружается в init_db
+# и обновляется /mode, чтобы вопрос не ходил в БД за режимом
+_chat_modes: Dict[int, str] = {}
+
+# Rate limit: время последнего вопроса по chat_id (time.monotonic). Состояние эфемерное,
+# поэтому держим его в памяти, а не в БД
+RATE_LIMIT_SECONDS = 5
+_RATE_LIMIT_PRUNE_AT = 10000 # при таком числе записей вычищаются истёкшие
+_last_request: Dict[int, float] = {}
+
+# Буфер ответов для записи в БД пачками: (chat_id, вопрос, ответ, UTC-время в формате CURRENT_TIMESTAMP).
+# Сбрасывается одной транзакцией раз в ANSWER_FLUSH_INTERVAL секунд или при ANSWER_FLUSH_SIZE строках
+ANSWER_FLUSH_INTERVAL = 2
+ANSWER_FLUSH_SIZE = 50
+_pending_answers: List[Tuple[int, str, str, str]] = []
+_answer_flush_task: asyncio.Task | None = None
+
+# Ссылки на фоновые задачи модуля (asyncio хранит только слабые ссылки на задачи)
+_background_tasks: set[asyncio.Task] = set()
+
+# --- Предкомпилированные регулярные выражения ---
+_RE_HTML_TAG = re.compile(r"<[^>]*>")
+_RE_BOT_PREFIX = re.compile(r'^🤖\s*(\*\*.*?\*\*[:\s]*)?(SwiftDevBot[:\s]*)?')
 
 # --- Инициализация БД ---
+@asynccontextmanager
+async def _write_tx(kernel_data: Dict[str, Any]):
+    """Транзакция записи на общем соединении: под db_write_lock, commit при успехе, rollback при ошибке.
+
+    Откат выполняется под тем же локом: иначе половина транзакции осталась бы открытой
+    и её зафиксировал бы следующий commit другого обработчика на этом соединении.
+    """
+    db = kernel_data["db"]
+    async with kernel_data["db_write_lock"]:
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            try: await db.rollback()
+            except aiosqlite.Error as e: logger.error(f"Ошибка отката транзакции: {e}")
+            raise
+
 async def init_db(kernel_data: Dict[str, Any]):
     """Инициализация таблиц модуля в основной БД."""
     db = kernel_data.get("db")
     if db is None: logger.error("❌ БД недоступна для инициализации GeminiAI"); return
     try:
-        await db.execute('''CREATE TABLE IF NOT EXISTS gemini_cache (question TEXT PRIMARY KEY, answer TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS gemini_conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, question TEXT, answer TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS gemini_settings (chat_id INTEGER PRIMARY KEY, mode TEXT DEFAULT 'friendly')''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS gemini_rate_limit (chat_id INTEGER PRIMARY KEY, last_request TIMESTAMP)''')
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_gemini_conv_chat_id ON gemini_conversations (chat_id)")
-        await db.commit()
+        # Схема (кроме gemini_cache) одним скриптом: один проход через поток aiosqlite вместо нескольких.
+        # executescript сначала фиксирует открытую транзакцию, поэтому выполняем под общим локом записи
+        async with _write_tx(kernel_data):
+            # WAL + synchronous=NORMAL: коммиты мелких вставок без fsync на каждый. journal_mode меняется только вне транзакции
+            await db.commit()
+            for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY", "mmap_size=268435456", "cache_size=-20000"):
+                await db.execute(f"PRAGMA {pragma}")
+            await db.executescript('''
+                CREATE TABLE IF NOT EXISTS gemini_conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, question TEXT, answer TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);
+                CREATE TABLE IF NOT EXISTS gemini_settings (chat_id INTEGER PRIMARY KEY, mode TEXT DEFAULT 'friendly');
+                DROP INDEX IF EXISTS idx_gemini_conv_chat_id;
+                CREATE INDEX IF NOT EXISTS idx_gemini_conv_chat_ts ON gemini_conversations (chat_id, timestamp DESC);
+            ''')
+            # gemini_cache и перенос старых схем (question TEXT / qhash BLOB PRIMARY KEY) — одной явной транзакцией:
+            # модуль sqlite3 сам фиксирует DDL вне BEGIN, и сбой посреди переноса оставил бы gemini_cache_legacy.
+            # Оставшаяся от прерванного переноса gemini_cache_legacy тоже дозаливается здесь
+            cache_columns = {row[1]: row[2].upper() for row in await db.execute_fetchall("PRAGMA table_info(gemini_cache)")}
+            migrate_cache = bool(cache_columns) and cache_columns.get("qhash") != "INTEGER"
+            has_legacy = bool(await db.execute_fetchall("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'gemini_cache_legacy'"))
+            await db.execute("BEGIN")
+            if migrate_cache:
+                await db.execute("DROP TABLE IF EXISTS gemini_cache_legacy")
+                await db.execute("ALTER TABLE gemini_cache RENAME TO gemini_cache_legacy")
+                await db.execute("DROP INDEX IF EXISTS idx_gemini_cache_ts") # Имя индекса освобождается для новой таблицы
+            await db.execute("CREATE TABLE IF NOT EXISTS gemini_cache (qhash INTEGER PRIMARY KEY, question TEXT, answer TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_gemini_cache_ts ON gemini_cache (timestamp)")
+            if migrate_cache or has_legacy:
+                legacy_rows = await db.execute_fetchall("SELECT question, answer, timestamp FROM gemini_cache_legacy")
+                await db.executemany("INSERT OR REPLACE INTO gemini_cache (qhash, question, answer, timestamp) VALUES (?, ?, ?, ?)", [(_question_hash(q), q, a, ts) for q, a, ts in legacy_rows])
+                await db.execute("DROP TABLE gemini_cache_legacy")
+                logger.info(f"gemini_cache переведён на целочисленный ключ BLAKE2b: перенесено {len(legacy_rows)} записей.")
+        _chat_modes.update(await db.execute_fetchall("SELECT chat_id, mode FROM gemini_settings"))
         logger.info("📊 Таблицы GeminiAI инициализированы.")
     except aiosqlite.Error as e: logger.error(f"❌ Ошибка init_db GeminiAI: {e}", exc_info=True)
 
 # --- Вспомогательные функции ---
-async def load_project_context() -> str:
-    """Асинхронно загружает контекст проекта из файла."""
-    # ... (оставляем как было или меняем на aiofiles) ...
+def _read_project_context() -> str:
+    """Читает контекст проекта из файла и запоминает его вместе с mtime."""
+    global _project_context, _ctx_mtime
     if CONTEXT_PATH and os.path.exists(CONTEXT_PATH):
         try:
+            mtime = os.stat(CONTEXT_PATH).st_mtime_ns
             with open(CONTEXT_PATH, "r", encoding="utf-8") as f:
                 content = f.read()
-                logger.info(f"Контекст загружен из {CONTEXT_PATH}: {len(content)} симв.")
-                return content
-        except OSError as e: logger.error(f"Ошибка чтения {CONTEXT_PATH}: {e}"); return DEFAULT_CONTEXT
-    else: logger.warning(f"Файл {CONTEXT_PATH} не найден."); return DEFAULT_CONTEXT
+            logger.info(f"Контекст загружен из {CONTEXT_PATH}: {len(content)} симв.")
+            _project_context, _ctx_mtime = content, mtime
+            return content
+        except OSError as e: logger.error(f"Ошибка чтения {CONTEXT_PATH}: {e}")
+    else: logger.warning(f"Файл {CONTEXT_PATH} не найден.")
+    _project_context, _ctx_mtime = DEFAULT_CONTEXT, None
+    return DEFAULT_CONTEXT
+
+async def load_project_context() -> str:
+    """Возвращает контекст проекта из памяти; файл перечитывается только при изменении mtime."""
+    try: mtime = os.stat(CONTEXT_PATH).st_mtime_ns if CONTEXT_PATH else None
+    except OSError: mtime = None
+    # Перечитывание файла — блокирующий I/O, уводим его из event loop
+    if mtime != _ctx_mtime: return await asyncio.to_thread(_read_project_context)
+    return _project_context
 
 def format_response(text: str) -> str:
     """Упрощенное форматирование ответа Gemini."""
-    text = re.sub(r'^🤖\s*(\*\*.*?\*\*[:\s]*)?(SwiftDevBot[:\s]*)?', '', text).strip()
-    text = text.replace('*', '')
-    lines = [line.strip() for line in text.splitlines() if line.strip()]
-    formatted_lines = []
-    for line in lines:
-         if len(line) < 60 or ':' in line.split(' ', 1)[0]: # Чуть изменим логику заголовка
-              formatted_lines.append(f"<b>{line}</b>")
-         else: formatted_lines.append(line)
+    text = _RE_BOT_PREFIX.sub('', text).strip().replace('*', '')
+    formatted_lines = []; append = formatted_lines.append
+    for line in text.splitlines(): # Один проход: strip один раз на строку, без временных списков
+         line = line.strip()
+         if not line: continue
+         if len(line) < 60 or ':' in line.partition(' ')[0]: append(f"<b>{line}</b>") # Короткая строка или "Ключ: ..." — заголовок
+         else: append(line)
     return "\n\n".join(formatted_lines)
 
 async def _reply_with_fallback(message: types.Message, text: str, **kwargs):
@@ -107,25 +255,141 @@ async def _reply_with_fallback(message: types.Message, text: str, **kwargs):
      try: await message.reply(text, parse_mode="HTML", **kwargs)
      except TelegramBadRequest as e:
          if "can't parse entities" in str(e):
-             logger.warning(f"Ошибка HTML: {e}. Попытка без форматирования."); safe_text = re.sub(r"<[^>]*>", "", text)
+             logger.warning(f"Ошибка HTML: {e}. Попытка без форматирования."); safe_text = _RE_HTML_TAG.sub("", text)
              await message.reply(safe_text, parse_mode=None, **kwargs)
          else: logger.error(f"Ошибка TG BadRequest: {e}"); await message.reply(f"❌ Ошибка: {e.message}", **kwargs)
      except Exception as e: logger.error(f"Ошибка отправки: {e}", exc_info=True); await message.reply("❌ Ошибка отправки.", **kwargs)
 
 def _get_decrypted_key(kernel_data: Dict[str, Any]) -> str | None:
     """Получает и дешифрует ключ API из конфига."""
+    global _key_cache
     fernet = kernel_data.get("encryption_key")
     encrypted_key = kernel_data.get("config", {}).get("module_secrets", {}).get("gemini_ai")
 
     if not fernet: logger.error("Ключ шифрования (Fernet) недоступен!"); return None
     if not encrypted_key: logger.debug("Зашифрованный ключ GeminiAI не найден в конфиге."); return None
 
+    if _key_cache is not None and _key_cache[0] == encrypted_key: return _key_cache[1]
     try:
         decrypted_key = fernet.decrypt(encrypted_key.encode()).decode()
+        _key_cache = (encrypted_key, decrypted_key)
         return decrypted_key
     except InvalidToken: logger.error("Неверный токен! Не удалось дешифровать ключ GeminiAI."); return None
     except Exception as e: logger.error(f"Ошибка дешифровки ключа GeminiAI: {e}", exc_info=True); return None
 
+def _write_config(config: Dict[str, Any], config_path: str):
+    """Атомарно записывает config.json: через временный файл и os.replace (вызывается в потоке)."""
+    # mkstemp создаёт файл с правами 0600; затем переносим права исходного конфига, чтобы не ослабить их
+    fd, tmp_path = tempfile.mkstemp(prefix=".config.", suffix=".tmp", dir=os.path.dirname(config_path))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=4, ensure_ascii=False)
+        if os.path.exists(config_path): shutil.copymode(config_path, tmp_path)
+        os.replace(tmp_path, config_path)
+    except BaseException:
+        try: os.unlink(tmp_path)
+        except OSError: pass
+        raise
+
+def _get_session() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию, создавая её при первом обращении."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60) # Вопросы идут с паузами: держим соединение дольше дефолтных 15 с
+        )
+    return _session
+
+def _question_hash(question: str) -> int:
+    """Ключ gemini_cache: 64-битный BLAKE2b от текста вопроса (знаковый, как rowid SQLite)."""
+    return int.from_bytes(hashlib.blake2b(question.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+def _pack_answer(answer: str) -> bytes:
+    """Сжимает ответ для gemini_cache (HTML-текст ответов жмётся в 3-5 раз)."""
+    return zlib.compress(answer.encode("utf-8"))
+
+def _unpack_answer(value: str | bytes) -> str:
+    """Распаковывает ответ из gemini_cache; строки, записанные до сжатия, возвращаются как есть."""
+    return value if isinstance(value, str) else zlib.decompress(value).decode("utf-8")
+
+def _answer_cache_get(question: str) -> str | None:
+    """Ищет ответ в LRU-кэше в памяти; просроченный (старше CACHE_TTL_DAYS) удаляется."""
+    entry = _answer_cache.get(question)
+    if entry is None: return None
+    if time.time() - entry[0] > CACHE_TTL_DAYS * 86400: del _answer_cache[question]; return None
+    _answer_cache.move_to_end(question)
+    return entry[1]
+
+def _answer_cache_put(question: str, answer: str, written_at: float | None = None):
+    """Кладёт ответ в LRU-кэш, вытесняя самый старый при переполнении. written_at — время записи ответа (по умолчанию сейчас)."""
+    _answer_cache[question] = (time.time() if written_at is None else written_at, answer)
+    _answer_cache.move_to_end(question)
+    if len(_answer_cache) > _ANSWER_CACHE_MAX: _answer_cache.popitem(last=False)
+
+def _negative_cache_get(chat_id: int, question: str) -> str | None:
+    """Возвращает сохранённый отказ Gemini для чата, если его срок ещё не истёк."""
+    key = (chat_id, question)
+    entry = _negative_cache.get(key)
+    if entry is None: return None
+    if entry[0] <= time.monotonic(): del _negative_cache[key]; return None
+    return entry[1]
+
+def _negative_cache_put(chat_id: int, question: str, answer: str):
+    """Запоминает отказ Gemini для чата на _NEGATIVE_CACHE_TTL секунд."""
+    key = (chat_id, question)
+    _negative_cache[key] = (time.monotonic() + _NEGATIVE_CACHE_TTL, answer)
+    _negative_cache.move_to_end(key)
+    if len(_negative_cache) > _NEGATIVE_CACHE_MAX: _negative_cache.popitem(last=False)
+
+def _spawn(coro, name: str | None = None) -> asyncio.Task:
+    """Запускает фоновую задачу, удерживая ссылку на неё до завершения."""
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task); task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _cache_gc(kernel_data: Dict[str, Any]):
+    """Периодическая очистка gemini_cache по сроку жизни и размеру, затем усечение WAL."""
+    while True:
+        await asyncio.sleep(CACHE_GC_INTERVAL)
+        db = kernel_data.get("db")
+        if db is None: continue
+        try:
+            async with _write_tx(kernel_data):
+                async with db.execute("DELETE FROM gemini_cache WHERE timestamp < datetime('now', ?)", (f"-{CACHE_TTL_DAYS} days",)) as c1: expired = c1.rowcount
+                async with db.execute("DELETE FROM gemini_cache WHERE timestamp < (SELECT timestamp FROM gemini_cache ORDER BY timestamp DESC LIMIT 1 OFFSET ?)", (CACHE_MAX_ROWS - 1,)) as c2: trimmed = c2.rowcount
+            async with kernel_data["db_write_lock"]: await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if expired or trimmed: logger.info(f"🧹 gemini_cache: удалено устаревших {expired}, сверх лимита {trimmed}.")
+        except aiosqlite.Error as e: logger.error(f"Ошибка очистки gemini_cache: {e}")
+
+def _queue_answer(kernel_data: Dict[str, Any], question: str, chat_id: int, full_answer: str):
+    """Ставит ответ Gemini в буфер записи; при заполнении буфера сбрасывает его сразу."""
+    _pending_answers.append((chat_id, question, full_answer, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())))
+    if len(_pending_answers) >= ANSWER_FLUSH_SIZE: _spawn(_flush_answers(kernel_data), name="gemini_ai_flush_answers")
+
+async def _flush_answers(kernel_data: Dict[str, Any]):
+    """Записывает накопленные ответы в кэш и историю диалога одной транзакцией."""
+    db = kernel_data.get("db")
+    if not _pending_answers or db is None: return
+    rows: List[Tuple[int, str, str, str]] = []
+    try:
+        async with _write_tx(kernel_data):
+            # Буфер забирается под локом и сразу ставится в очередь aiosqlite первой операцией: чтение истории,
+            # поставленное позже, увидит эти строки (то же соединение); ask_gemini берёт свой снимок буфера до чтения
+            rows = _pending_answers[:]; _pending_answers.clear()
+            if not rows: return
+            await db.executemany("INSERT INTO gemini_conversations (chat_id, question, answer, timestamp) VALUES (?, ?, ?, ?)", rows)
+            await db.executemany("INSERT OR REPLACE INTO gemini_cache (qhash, question, answer, timestamp) VALUES (?, ?, ?, ?)",
+                                 [(_question_hash(q), q, _pack_answer(a), ts) for _, q, a, ts in rows if len(q) <= CACHE_QUESTION_MAX_LENGTH])
+    except aiosqlite.Error as e: logger.error(f"Ошибка сохранения {len(rows)} ответов Gemini: {e}")
+
+async def _answer_flusher(kernel_data: Dict[str, Any]):
+    """Периодически сбрасывает буфер ответов в БД."""
+    while True:
+        await asyncio.sleep(ANSWER_FLUSH_INTERVAL)
+        # Сброс идёт отдельной задачей: отмена флашера при остановке не прерывает транзакцию на середине
+        if _pending_answers: await asyncio.shield(_spawn(_flush_answers(kernel_data), name="gemini_ai_flush_answers"))
+
 # --- Основная функция запроса к Gemini ---
 async def ask_gemini(kernel_data: Dict[str, Any], question: str, chat_id: int) -> str:
     """Запрос к Gemini AI."""
@@ -135,24 +399,32 @@ async def ask_gemini(kernel_data: Dict[str, Any], question: str, chat_id: int) -
     if db is None: logger.error("❌ БД недоступна"); return "❌ Ошибка: БД недоступна."
     if not gemini_key: return "❌ Ошибка: API ключ Gemini не настроен или не может быть дешифрован. Установите через /sysconf."
 
-    # 1. Проверка кэша
-    # ... (без изменений) ...
+    # 1. Проверка кэша (сначала в памяти, затем в БД); режим общения берётся из памяти
+    cached = _answer_cache_get(question)
+    if cached: logger.info(f"🔍 Кэш (память): '{question[:50]}...'"); return cached
+    blocked = _negative_cache_get(chat_id, question)
+    if blocked: logger.info(f"🔍 Негативный кэш: '{question[:50]}...'"); return blocked
+    mode = _chat_modes.get(chat_id, 'friendly'); history_context = ''
     try:
-        async with db.execute("SELECT answer FROM gemini_cache WHERE question = ?", (question,)) as cursor:
-            cached = await cursor.fetchone()
-        if cached: logger.info(f"🔍 Кэш: '{question[:50]}...'"); return cached[0]
-    except aiosqlite.Error as e: logger.error(f"Ошибка чтения кэша: {e}")
-
-    # 2. Получение настроек и истории
-    # ... (без изменений) ...
-    mode = 'friendly'; history_context = ''
+        # execute_fetchall: один переход в поток aiosqlite, без жизненного цикла курсора
+        # Просроченные строки, которые фоновая очистка ещё не удалила, не считаются попаданием
+        rows = await db.execute_fetchall("SELECT answer, CAST(strftime('%s', timestamp) AS INTEGER) FROM gemini_cache WHERE qhash = ? AND question = ? AND timestamp >= datetime('now', ?)",
+                                         (_question_hash(question), question, f"-{CACHE_TTL_DAYS} days"))
+        if rows:
+            logger.info(f"🔍 Кэш: '{question[:50]}...'"); cached = _unpack_answer(rows[0][0])
+            _answer_cache_put(question, cached, rows[0][1]); return cached
+    except (aiosqlite.Error, zlib.error) as e: logger.error(f"Ошибка чтения кэша: {e}")
+
+    # 2. Получение истории
+    # Ответы из буфера записи ещё не в БД, но уже часть диалога. Снимок берётся ДО чтения: SELECT встаёт в очередь
+    # aiosqlite без промежуточного await, поэтому строки, которые флаш заберёт из буфера позже, вставятся уже после
+    # этого SELECT и не потеряются; строки, забранные флашем раньше, SELECT увидит сам
+    pending = [(q, a) for cid, q, a, _ in _pending_answers if cid == chat_id]
     try:
-        async with db.execute("SELECT mode FROM gemini_settings WHERE chat_id = ?", (chat_id,)) as cursor:
-            mode_result = await cursor.fetchone(); mode = mode_result[0] if mode_result else mode
-        async with db.execute("SELECT question, answer FROM gemini_conversations WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 5", (chat_id,)) as cursor:
-            history = await cursor.fetchall()
-            if history: history_context = "\n".join([f"User: {q}\nAI: {re.sub('<[^>]*>', '', a)}" for q, a in reversed(history)])
-    except aiosqlite.Error as e: logger.error(f"Ошибка получения настроек/истории: {e}")
+        history = list(reversed(await db.execute_fetchall("SELECT question, answer FROM gemini_conversations WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 5", (chat_id,))))
+    except aiosqlite.Error as e: logger.error(f"Ошибка получения истории: {e}"); history = []
+    history = (history + pending)[-5:]
+    if history: history_context = "\n".join([f"User: {q}\nAI: {_RE_HTML_TAG.sub('', a)}" for q, a in history])
 
     # 3. Формирование промпта
     # ... (без изменений) ...
@@ -168,64 +440,76 @@ async def ask_gemini(kernel_data: Dict[str, Any], question: str, chat_id: int) -
         "generationConfig": {"temperature": 0.8, "topK": 10, "topP": 0.95, "maxOutputTokens": 2048},
         "safetySettings": [{"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]]
     }
+    body = _json_dumps(payload) # Сериализуем один раз, а не на каждой попытке
     max_retries = 2; base_delay = 1.5
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-        for attempt in range(max_retries):
-            try:
-                logger.info(f"-> Gemini [Поп. {attempt+1}/{max_retries}]: '{question[:50]}...'")
-                async with session.post(url, json=payload) as response:
-                    # ... (логика обработки ответа, ретраев, ошибок - без изменений) ...
-                    if response.status == 200:
-                        try:
-                            result = await response.json()
-                            if result.get("candidates") and result["candidates"][0].get("content", {}).get("parts"):
-                                raw_answer = result["candidates"][0]["content"]["parts"][0]["text"]
-                                formatted_answer = format_response(raw_answer)
-                                full_answer = f"<b>🤖 SwiftDevBot:</b>\n\n{formatted_answer}" # Заголовок ДО кэша
-                                try: # Сохраняем в БД
-                                     await db.execute("INSERT OR REPLACE INTO gemini_cache (question, answer) VALUES (?, ?)", (question, full_answer))
-                                     await db.execute("INSERT INTO gemini_conversations (chat_id, question, answer) VALUES (?, ?, ?)", (chat_id, question, full_answer))
-                                     await db.commit()
-                                except aiosqlite.Error as db_e: logger.error(f"Ошибка сохранения ответа Gemini: {db_e}")
-                                logger.info(f"<- Ответ Gemini получен для '{question[:50]}...'")
-                                return full_answer
-                            else: # Ответ 200, но нет кандидата
-                                reason = result.get("promptFeedback", {}).get("blockReason", "Неизвестно")
-                                logger.warning(f"Нет кандидата от Gemini. Причина: {reason}."); return f"❌ Ответ не сгенерирован (Фильтр: {reason})."
-                        except (aiohttp.ContentTypeError, json.JSONDecodeError) as json_err: logger.error(f"Ошибка JSON Gemini: {json_err}"); return "❌ Ошибка обработки ответа ИИ."
-                    elif response.status in [429, 500, 503] and attempt < max_retries - 1: # Ошибки сервера/лимиты
-                        delay = base_delay * (2 ** attempt); logger.warning(f"Gemini {response.status}. Повтор через {delay:.1f} сек..."); await asyncio.sleep(delay); continue
-                    else: # Другие ошибки
-                        err_text = await response.text(); logger.error(f"Ошибка Gemini {response.status}: {err_text[:500]}"); msg = "❌ Ошибка ИИ.";
-                        if response.status == 400: msg = "❌ Ошибка запроса (API ключ?)."; elif response.status == 429: msg = "❌ Лимит запросов."; elif response.status >= 500: msg = "❌ Ошибка сервера ИИ."; return msg
-            except asyncio.TimeoutError: logger.error(f"Таймаут Gemini (Поп. {attempt + 1})"); if attempt < max_retries - 1: await asyncio.sleep(base_delay); continue; else: return "❌ ИИ не ответил вовремя."
-            except aiohttp.ClientError as e: logger.error(f"Ошибка сети Gemini (Поп. {attempt + 1}): {e}"); if attempt < max_retries - 1: await asyncio.sleep(base_delay); continue; else: return "❌ Ошибка сети ИИ."
-            except Exception as e: logger.error(f"Ошибка ask_gemini (Поп. {attempt + 1}): {e}", exc_info=True); 
-            if attempt < max_retries - 1: await asyncio.sleep(base_delay); continue; else: return "❌ Внутренняя ошибка ИИ."
-        return "❌ ИИ не отвечает после нескольких попыток." # Если все ретраи не удались
+    session = _get_session()
+    for attempt in range(max_retries):
+        try:
+            logger.info(f"-> Gemini [Поп. {attempt+1}/{max_retries}]: '{question[:50]}...'")
+            async with session.post(url, data=body, headers={"Content-Type": "application/json"}) as response:
+                if response.status == 200:
+                    try:
+                        result = _json_loads(await response.read())
+                        if result.get("candidates") and result["candidates"][0].get("content", {}).get("parts"):
+                            raw_answer = result["candidates"][0]["content"]["parts"][0]["text"]
+                            formatted_answer = format_response(raw_answer)
+                            full_answer = f"<b>🤖 SwiftDevBot:</b>\n\n{formatted_answer}" # Заголовок ДО кэша
+                            if len(question) <= CACHE_QUESTION_MAX_LENGTH: _answer_cache_put(question, full_answer)
+                            # Запись в БД идёт пачками в фоне и не задерживает отправку ответа пользователю
+                            _queue_answer(kernel_data, question, chat_id, full_answer)
+                            logger.info(f"<- Ответ Gemini получен для '{question[:50]}...'")
+                            return full_answer
+                        else: # Ответ 200, но нет кандидата
+                            reason = result.get("promptFeedback", {}).get("blockReason", "Неизвестно")
+                            logger.warning(f"Нет кандидата от Gemini. Причина: {reason}.")
+                            blocked = f"❌ Ответ не сгенерирован (Фильтр: {reason})."; _negative_cache_put(chat_id, question, blocked); return blocked
+                    except ValueError as json_err: logger.error(f"Ошибка JSON Gemini: {json_err}"); return "❌ Ошибка обработки ответа ИИ." # (orjson.)JSONDecodeError — подкласс ValueError
+                elif response.status in [429, 500, 503] and attempt < max_retries - 1: # Ошибки сервера/лимиты
+                    delay = base_delay * (2 ** attempt); logger.warning(f"Gemini {response.status}. Повтор через {delay:.1f} сек..."); await asyncio.sleep(delay); continue
+                else: # Другие ошибки
+                    err_text = await response.text(); logger.error(f"Ошибка Gemini {response.status}: {err_text[:500]}"); msg = "❌ Ошибка ИИ."
+                    if response.status == 400: msg = "❌ Ошибка запроса (API ключ?)."
+                    elif response.status == 429: msg = "❌ Лимит запросов."
+                    elif response.status >= 500: msg = "❌ Ошибка сервера ИИ."
+                    return msg
+        except asyncio.TimeoutError:
+            logger.error(f"Таймаут Gemini (Поп. {attempt + 1})")
+            if attempt < max_retries - 1: await asyncio.sleep(base_delay); continue
+            return "❌ ИИ не ответил вовремя."
+        except aiohttp.ClientError as e:
+            logger.error(f"Ошибка сети Gemini (Поп. {attempt + 1}): {e}")
+            if attempt < max_retries - 1: await asyncio.sleep(base_delay); continue
+            return "❌ Ошибка сети ИИ."
+        except Exception as e:
+            logger.error(f"Ошибка ask_gemini (Поп. {attempt + 1}): {e}", exc_info=True)
+            if attempt < max_retries - 1: await asyncio.sleep(base_delay); continue
+            return "❌ Внутренняя ошибка ИИ."
+    return "❌ ИИ не отвечает после нескольких попыток." # Если все ретраи не удались
 
 # --- Обработчики сообщений ---
-@router.message(F.text & ~F.text.startswith('/') & (F.text.len() >= 3) & F.chat.type == "private")
+@router.message(F.text & ~F.text.startswith('/') & (F.text.len() >= 3) & (F.text.len() <= MAX_QUESTION_LENGTH) & (F.chat.type == "private"))
 async def handle_message(message: types.Message, kernel_data: dict):
     """Обработка текстовых сообщений как вопросов к Gemini."""
     db = kernel_data.get("db"); bot_ = kernel_data.get("bot")
     if db is None or bot_ is None: await message.reply("❌ Ошибка: Сервис временно недоступен."); return
 
     chat_id = message.chat.id; user_id = message.from_user.id; question = message.text
-    rate_limit_seconds = 5; now = datetime.now(timezone.utc)
-    try:
-        async with db.execute("SELECT last_request FROM gemini_rate_limit WHERE chat_id = ?", (chat_id,)) as cursor: last_req_data = await cursor.fetchone()
-        if last_req_data: last_req_time = datetime.fromisoformat(last_req_data[0]).replace(tzinfo=timezone.utc);
-        if (now - last_req_time) < timedelta(seconds=rate_limit_seconds): await message.reply(f"⏳ Подожди {rate_limit_seconds} сек."); return
-    except (aiosqlite.Error, ValueError) as e: logger.error(f"Ошибка rate limit {chat_id}: {e}")
+    now = time.monotonic()
+    if now - _last_request.get(chat_id, -RATE_LIMIT_SECONDS) < RATE_LIMIT_SECONDS: await message.reply(f"⏳ Подожди {RATE_LIMIT_SECONDS} сек."); return
+    _last_request[chat_id] = now
+    if len(_last_request) > _RATE_LIMIT_PRUNE_AT:
+        for stale_id in [cid for cid, ts in _last_request.items() if now - ts >= RATE_LIMIT_SECONDS]: del _last_request[stale_id]
 
     await bot_.send_chat_action(chat_id=chat_id, action="typing")
     answer = await ask_gemini(kernel_data, question, chat_id)
     await _reply_with_fallback(message, answer)
-    try: await db.execute("INSERT OR REPLACE INTO gemini_rate_limit (chat_id, last_request) VALUES (?, ?)", (chat_id, now.isoformat())); await db.commit()
-    except aiosqlite.Error as e: logger.error(f"Ошибка обновления rate limit {chat_id}: {e}")
     logger.info(f"🤖 Вопрос от {user_id}: '{question[:50]}...'")
 
+@router.message(F.text & ~F.text.startswith('/') & (F.text.len() > MAX_QUESTION_LENGTH) & (F.chat.type == "private"))
+async def handle_too_long_message(message: types.Message):
+    """Отказ для слишком длинных вопросов — до кэша, БД и API."""
+    await message.reply(f"✂️ Вопрос слишком длинный: {len(message.text)} симв. Максимум — {MAX_QUESTION_LENGTH}.")
+
 
 # --- Обработчики команд ---
 @router.message(Command("mode"))
@@ -234,21 +518,22 @@ async def mode_command(message: types.Message, command: CommandObject, kernel_da
     db = kernel_data.get("db");
     if db is None: await message.reply("❌ Ошибка: БД недоступна."); return
 
-    new_mode = command.args.strip().lower() if command.args else None
+    # Аргументы разбираются один раз (CommandObject); "/mode " с пустым аргументом трактуется как показ текущего режима
+    new_mode = (command.args or "").strip().lower() or None
     valid_modes = ["formal", "friendly", "sarcastic"]
     chat_id = message.chat.id
 
     if not new_mode: # Показываем текущий режим
-        current_mode = 'friendly'
-        try: async with db.execute("SELECT mode FROM gemini_settings WHERE chat_id = ?", (chat_id,)) as c: mode_res = await c.fetchone(); current_mode = mode_res[0] if mode_res else current_mode
-        except aiosqlite.Error as e: logger.error(f"Ошибка получения режима {chat_id}: {e}"); await message.reply("❌ Ошибка получения режима."); return
+        current_mode = _chat_modes.get(chat_id, 'friendly')
         await message.reply(f"ℹ️ Текущий: `{current_mode}`.\nДоступные: {', '.join([f'`{m}`' for m in valid_modes])}\nИспользуйте: `/mode [режим]`", parse_mode="Markdown")
         return
 
     if new_mode not in valid_modes: await message.reply(f"❌ Неверный режим. Доступны: {', '.join([f'`{m}`' for m in valid_modes])}", parse_mode="Markdown"); return
 
-    try: await db.execute("INSERT OR REPLACE INTO gemini_settings (chat_id, mode) VALUES (?, ?)", (chat_id, new_mode)); await db.commit()
+    try:
+        async with _write_tx(kernel_data): await db.execute("INSERT OR REPLACE INTO gemini_settings (chat_id, mode) VALUES (?, ?)", (chat_id, new_mode))
     except aiosqlite.Error as e: logger.error(f"Ошибка смены режима: {e}"); await message.reply("❌ Ошибка сохранения режима."); return
+    _chat_modes[chat_id] = new_mode
     await message.reply(f"✅ Режим ИИ изменён на: `{new_mode}`", parse_mode="Markdown")
     logger.info(f"Режим для {message.from_user.id} изменён на {new_mode}")
 
@@ -260,9 +545,11 @@ async def clear_cache_command(message: types.Message, kernel_data: dict):
     db = kernel_data.get("db");
     if db is None: await message.reply("❌ Ошибка: БД недоступна."); return
     try:
-        async with db.execute("SELECT COUNT(*) FROM gemini_cache") as c1: cache_count = (await c1.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM gemini_conversations") as c2: conv_count = (await c2.fetchone())[0]
-        await db.execute("DELETE FROM gemini_cache"); await db.execute("DELETE FROM gemini_conversations"); await db.commit()
+        _pending_answers.clear()
+        async with _write_tx(kernel_data):
+            async with db.execute("DELETE FROM gemini_cache") as c1: cache_count = c1.rowcount
+            async with db.execute("DELETE FROM gemini_conversations") as c2: conv_count = c2.rowcount
+        _answer_cache.clear(); _negative_cache.clear()
         await message.reply(f"🧹 Кэш (`{cache_count}`) и история (`{conv_count}`) GeminiAI очищены.", parse_mode="Markdown")
         logger.info(f"Кэш/история GeminiAI очищены админом {message.from_user.id}")
     except aiosqlite.Error as e: logger.error(f"Ошибка очистки GeminiAI: {e}"); await message.reply(f"❌ Ошибка: `{e}`")
@@ -285,6 +572,7 @@ async def set_key_start(callback: types.CallbackQuery, state: FSMContext, kernel
 # Обработчик получения ключа в состоянии FSM
 @router.message(GeminiAIStates.waiting_for_api_key, F.text)
 async def process_api_key(message: types.Message, state: FSMContext, kernel_data: dict):
+    global _key_cache
     api_key = message.text.strip()
     original_message_id = message.message_id # Запоминаем ID для удаления
     try: await message.delete() # Сразу удаляем сообщение с ключом
@@ -306,9 +594,9 @@ async def process_api_key(message: types.Message, state: FSMContext, kernel_data
         config_path = os.path.join(kernel_data["base_dir"], "data", "config.json")
         config = kernel_data["config"]
         config.setdefault("module_secrets", {})["gemini_ai"] = encrypted_key
+        _key_cache = None
 
-        with open(config_path, "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
+        await asyncio.to_thread(_write_config, config, config_path)
         logger.info(f"Ключ GeminiAI сохранен (зашифрован) админом {message.from_user.id}")
         # Отправляем новое сообщение об успехе
         await message.answer("✅ API ключ Gemini успешно сохранен и зашифрован.", reply_markup=ReplyKeyboardRemove())
@@ -348,9 +636,16 @@ async def cancel_key_handler(message: types.Message, state: FSMContext):
 # --- Функции жизненного цикла модуля ---
 def setup(kernel_data: dict):
     """Настройка модуля GeminiAI."""
-    global CONTEXT_PATH
+    global CONTEXT_PATH, _log_listener
     base_dir = kernel_data.get("base_dir", ".")
     CONTEXT_PATH = os.path.join(base_dir, "data", "swiftdevbot_context.txt")
+    _read_project_context()
+
+    # Общее соединение kernel_data["db"] используется всеми модулями; модули не должны
+    # открывать файл БД повторно. Записи (execute...commit) сериализуются через общий лок
+    # kernel_data["db_write_lock"] — его берут gemini_ai (через _write_tx), youtube_downloader
+    # и шаблон Sample.py, — чтобы commit одного обработчика не зафиксировал полутранзакцию другого.
+    kernel_data.setdefault("db_write_lock", asyncio.Lock())
 
     # Проверка наличия cryptography
     if not CRYPTOGRAPHY_AVAILABLE:
@@ -362,11 +657,18 @@ def setup(kernel_data: dict):
     log_dir = os.path.join(base_dir, "data"); os.makedirs(log_dir, exist_ok=True)
     module_log_path = os.path.join(log_dir, "gemini_ai.log")
     try:
-        # Избегаем дублирования хендлера при перезапусках
-        if not any(isinstance(h, RotatingFileHandler) and h.baseFilename == module_log_path for h in logger.handlers):
+        # Избегаем дублирования хендлера при перезапусках. Логгер переживает /reload, а глобальные переменные модуля — нет:
+        # хендлер прошлого экземпляра снимается вместе с его слушателем (поток и открытый файл лога), затем создаётся новый
+        abs_log_path = os.path.abspath(module_log_path)
+        if _log_listener is None: _remove_queue_handlers(abs_log_path)
+        if not any(isinstance(h, QueueHandler) and getattr(h, "log_path", None) == abs_log_path for h in logger.handlers):
             log_handler = RotatingFileHandler(module_log_path, maxBytes=5*1024*1024, backupCount=3, encoding="utf-8")
             log_handler.setLevel(logging.INFO); log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"); log_handler.setFormatter(log_formatter)
-            logger.addHandler(log_handler)
+            log_queue = queue.SimpleQueue()
+            queue_handler = QueueHandler(log_queue); queue_handler.setLevel(logging.INFO); queue_handler.log_path = abs_log_path
+            _log_listener = QueueListener(log_queue, log_handler, respect_handler_level=True); _log_listener.start()
+            queue_handler.log_listener = _log_listener
+            logger.addHandler(queue_handler)
         logger.info(f"Настроен лог-файл: {module_log_path}")
     except Exception as e: logger.error(f"Не удалось настроить логгер: {e}")
 
@@ -418,6 +720,10 @@ def get_settings(kernel_data: dict) -> tuple[str, Optional[InlineKeyboardMarkup]
 
 async def on_startup(bot: Bot, data: dict):
     """Действия при запуске."""
+    global _cache_gc_task, _answer_flush_task
+    _get_session()
+    if _cache_gc_task is None or _cache_gc_task.done(): _cache_gc_task = asyncio.create_task(_cache_gc(data), name="gemini_ai_cache_gc")
+    if _answer_flush_task is None or _answer_flush_task.done(): _answer_flush_task = asyncio.create_task(_answer_flusher(data), name="gemini_ai_answer_flusher")
     # Проверяем доступность ключа шифрования и API ключа
     if not CRYPTOGRAPHY_AVAILABLE:
          logger.error("❌ Cryptography не найден. GeminiAI не сможет использовать API ключ.")
@@ -428,8 +734,10 @@ async def on_startup(bot: Bot, data: dict):
          # Уведомляем админов один раз при старте
          admin_ids = data.get("admin_ids", [])
          msg = "⚠️ API ключ для **GeminiAI** не установлен или не может быть дешифрован. Установите его через `/sysconf`."
-         tasks = [bot.send_message(aid, msg, parse_mode="Markdown") for aid in admin_ids]
-         await asyncio.gather(*tasks, return_exceptions=True)
+         sem = asyncio.Semaphore(5) # Не более 5 одновременных отправок, чтобы не упираться во flood-лимиты TG
+         async def _notify(aid: int):
+             async with sem: return await bot.send_message(aid, msg, parse_mode="Markdown")
+         await asyncio.gather(*(_notify(aid) for aid in admin_ids), return_exceptions=True)
     else:
         logger.info("🚀 Модуль GeminiAI запущен с активным API ключом.")
 
@@ -441,4 +749,14 @@ async def on_startup(bot: Bot, data: dict):
 
 async def on_shutdown(bot: Bot, data: dict):
     """Действия при завершении."""
-    logger.info("📴 Модуль GeminiAI завершает работу.")
\ No newline at end of file
+    global _session, _cache_gc_task, _answer_flush_task, _log_listener
+    if _cache_gc_task is not None: _cache_gc_task.cancel(); _cache_gc_task = None
+    if _answer_flush_task is not None: _answer_flush_task.cancel(); _answer_flush_task = None
+    if _background_tasks: await asyncio.gather(*_background_tasks, return_exceptions=True) # Дожидаемся фоновых записей в БД
+    await _flush_answers(data) # Остаток буфера ответов
+    if _session is not None and not _session.closed: await _session.close()
+    _session = None
+    logger.info("📴 Модуль GeminiAI завершает работу.")
+    if _log_listener is not None:
+        _remove_queue_handlers() # Снимает хендлер и останавливает его слушателя
+        _log_listener = None
\ No newline at end of file
@@ -20,6 +20,18 @@ kernel_data = None
 MODULE_NAME = "youtube_downloader"
 DISPLAY_NAME = "YouTube Downloader 📹"
 DESCRIPTION = "Скачивает видео и аудио с YouTube, Facebook, Instagram и других платформ."
+TABLE_NAME = f"{MODULE_NAME}_config"
+
+# SQL-запросы модуля (имя таблицы фиксировано, форматируются один раз)
+_SQL_CREATE_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+        user_id INTEGER PRIMARY KEY,
+        default_format TEXT,
+        default_quality TEXT
+    )
+"""
+_SQL_GET_USER = f"SELECT default_format, default_quality FROM {TABLE_NAME} WHERE user_id = ?"
+_SQL_SET_USER = f"INSERT OR REPLACE INTO {TABLE_NAME} (user_id, default_format, default_quality) VALUES (?, ?, ?)"
 
 # Определение состояний FSM
 class YoutubeStates(StatesGroup):
@@ -57,6 +69,8 @@ def setup(data):
     if db is None:
         logger.error("База данных не инициализирована в kernel_data['db']!")
         raise ValueError("База данных не инициализирована!")
+    # Соединение kernel_data["db"] общее для всех модулей: записи (execute...commit) идут под общим локом
+    kernel_data.setdefault("db_write_lock", asyncio.Lock())
     
     base_dir = kernel_data.get("base_dir", os.path.expanduser("~/SwiftDevBot"))
     asyncio.create_task(init_db(db))
@@ -65,16 +79,14 @@ def setup(data):
 
 async def init_db(db):
     """Инициализация таблицы настроек."""
-    table_name = f"{MODULE_NAME}_config"
-    await db.execute(f"""
-        CREATE TABLE IF NOT EXISTS {table_name} (
-            user_id INTEGER PRIMARY KEY,
-            default_format TEXT,
-            default_quality TEXT
-        )
-    """)
-    await db.commit()
-    logger.info(f"Таблица {table_name} создана")
+    async with kernel_data["db_write_lock"]:
+        try:
+            await db.execute(_SQL_CREATE_TABLE)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    logger.info(f"Таблица {TABLE_NAME} создана")
 
 def init_config(base_dir):
     """Инициализация конфигурационного файла."""
@@ -96,21 +108,21 @@ def load_config(base_dir):
 
 async def get_user_config(db, user_id):
     """Получение пользовательских настроек."""
-    table_name = f"{MODULE_NAME}_config"
-    async with db.execute(f"SELECT default_format, default_quality FROM {table_name} WHERE user_id = ?", (user_id,)) as cursor:
+    async with db.execute(_SQL_GET_USER, (user_id,)) as cursor:
         row = await cursor.fetchone()
     return {"default_format": row[0], "default_quality": row[1]} if row else {}
 
 async def set_user_config(db, user_id, config):
     """Сохранение пользовательских настроек."""
-    table_name = f"{MODULE_NAME}_config"
     default_format = config.get("default_format", USER_PARAMETERS["default_format"]["default"])
     default_quality = config.get("default_quality", USER_PARAMETERS["default_quality"]["default"])
-    await db.execute(
-        f"INSERT OR REPLACE INTO {table_name} (user_id, default_format, default_quality) VALUES (?, ?, ?)",
-        (user_id, default_format, default_quality)
-    )
-    await db.commit()
+    async with kernel_data["db_write_lock"]:
+        try:
+            await db.execute(_SQL_SET_USER, (user_id, default_format, default_quality))
+            await db.commit()
+        except Exception:
+            await db.rollback() # Откат под тем же локом, чтобы полутранзакцию не зафиксировал чужой commit
+            raise
     logger.info(f"Настройки пользователя {user_id} обновлены: {config}")
 
 def get_settings(kernel_data):